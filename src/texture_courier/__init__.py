@@ -3,6 +3,7 @@ import sys
 from .cli import main
 from .core import Header, Entry  # noqa
 from .api import TextureCache, Texture  # noqa
+from .aio import AsyncTextureCache  # noqa
 from .find import list_texture_caches  # noqa
 
 
@@ -0,0 +1,190 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Optional, Self, TypeVar
+from watchdog.observers import Observer
+from watchdog.events import (
+    PatternMatchingEventHandler,
+    DirModifiedEvent,
+    FileModifiedEvent,
+)
+
+from .api import Texture, TextureCache
+from .core import Header, InconsistentCacheError
+
+from PIL import Image
+
+T = TypeVar("T")
+
+
+class AsyncTextureCache:
+    """
+    asyncio wrapper around TextureCache.
+
+    blocking work (parsing the cache, reading and decoding textures) runs in a
+    bounded thread pool, so a single event loop can serve many caches at once.
+    refreshes are serialized per cache, and file system events are handed to
+    the event loop instead of running a handler on the watchdog thread.
+    """
+
+    cache: TextureCache
+    executor: ThreadPoolExecutor
+
+    def __init__(
+        self,
+        cache: TextureCache,
+        *,
+        max_workers: int | None = None,
+        executor: ThreadPoolExecutor | None = None,
+    ):
+        self.cache = cache
+        # a pool handed in by the caller may be shared by other caches, so it
+        # is only shut down by whoever created it
+        self._owns_executor = executor is None
+        self.executor = executor if executor is not None else ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="texture-courier"
+        )
+        self._refresh_lock = asyncio.Lock()
+
+    @classmethod
+    async def open(
+        cls,
+        cache_dir: str | Path,
+        *,
+        max_workers: int | None = None,
+        executor: ThreadPoolExecutor | None = None,
+        snapshot_path: str | Path | None = None,
+    ) -> Self:
+        """
+        Open and parse a texture cache without blocking the event loop.
+
+        pass an executor to share one bounded pool between several caches.
+        otherwise a pool of max_workers threads is created for this cache.
+        """
+
+        owns_executor = executor is None
+
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="texture-courier")
+
+        loop = asyncio.get_running_loop()
+
+        try:
+            cache = await loop.run_in_executor(
+                executor, lambda: TextureCache(cache_dir, snapshot_path=snapshot_path)
+            )
+        except BaseException:
+            if owns_executor:
+                executor.shutdown(wait=False)
+
+            raise
+
+        self = cls(cache, executor=executor)
+        self._owns_executor = owns_executor
+
+        return self
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        await self.close()
+
+    async def __aiter__(self) -> AsyncIterator[Texture]:
+        # snapshot so a concurrent refresh can't change the dict mid-iteration
+        for texture in list(self.cache):
+            yield texture
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def __repr__(self) -> str:
+        return f"<AsyncTextureCache {self.cache_dir.resolve()}, {len(self)} textures>"
+
+    @property
+    def cache_dir(self) -> Path:
+        return self.cache.cache_dir
+
+    @property
+    def header(self) -> Header:
+        return self.cache.header
+
+    async def _run(self, fn: Callable[..., T], *args: Any) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    async def refresh(self) -> list[Texture]:
+        """Re-read the cache and return the textures that changed"""
+
+        async with self._refresh_lock:
+            return await self._run(lambda: list(self.cache.refresh()))
+
+    async def loads(self, texture: Texture) -> bytes:
+        """Read a texture as a bytes object"""
+        return await self._run(texture.loads)
+
+    async def open_image(self, texture: Texture) -> Image.Image:
+        """Open texture as a pillow image, fully decoded"""
+
+        def open_image() -> Image.Image:
+            im = texture.open_image()
+            # pillow decodes lazily, so force it here rather than on the loop
+            im.load()
+            return im
+
+        return await self._run(open_image)
+
+    async def changes(self) -> AsyncIterator[list[Texture]]:
+        """
+        Watch the cache directory and yield lists of changed textures.
+
+        bursts of file system events are coalesced into a single refresh.
+        the observer is stopped when the iterator is closed.
+        """
+
+        loop = asyncio.get_running_loop()
+        modified = asyncio.Event()
+
+        def on_modified(event: DirModifiedEvent | FileModifiedEvent) -> None:
+            loop.call_soon_threadsafe(modified.set)
+
+        event_handler = PatternMatchingEventHandler(patterns=["texture.entries", "texture.cache"])
+        setattr(event_handler, "on_modified", on_modified)
+
+        observer = Observer()
+        observer.schedule(event_handler, str(self.cache_dir.resolve()))
+        observer.start()
+
+        try:
+            while True:
+                await modified.wait()
+                modified.clear()
+
+                try:
+                    changed_textures = await self.refresh()
+                except InconsistentCacheError:
+                    # the viewer is still writing, the next modification will catch up
+                    continue
+
+                if changed_textures:
+                    yield changed_textures
+        finally:
+            observer.stop()
+            await loop.run_in_executor(None, observer.join)
+
+    async def close(self) -> None:
+        if not self._owns_executor:
+            return
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.executor.shutdown)
+
+    def get(self, uuid: str, default: Optional[T] = None) -> Texture | T:
+        return self.cache.get(uuid, default)
+
+    @property
+    def generation(self) -> int:
+        return self.cache.generation
+
+    def is_stale(self, texture: Texture) -> bool:
+        return self.cache.is_stale(texture)
@@ -1,6 +1,9 @@
+from datetime import datetime
+from functools import cached_property
 from io import BytesIO
 from pathlib import Path
-from typing import Any, Callable, Iterator, Optional, TypeVar
+import time
+from typing import Any, Callable, Iterable, Iterator, Optional, TypeVar
 from watchdog.observers import Observer
 from watchdog.observers.api import BaseObserver
 from watchdog.events import (
@@ -12,11 +15,19 @@ from watchdog.events import (
 from .core import (
     Header,
     Entry,
+    InconsistentCacheError,
+    JPEG2000_SOC,
+    TEXTURE_CACHE_BYTE_COUNT,
+    read_cache_files,
     read_texture_cache,
     read_texture_body,
     texture_location,
     decode_texture_entries,
 )
+from .j2k import Salvaged, salvage_codestream
+from .plan import plan_extraction
+from .shard import Shard
+from .snapshot import EntriesKey, Snapshot, read_snapshot, write_snapshot
 from .util import format_bytes
 
 from PIL import Image
@@ -24,13 +35,26 @@ from PIL import Image
 T = TypeVar("T")
 
 
-def loads_bytes_io(p: Path) -> BytesIO:
-    return BytesIO(p.read_bytes())
+class HeadBuffer:
+    """
+    The texture.cache contents that textures read their heads from.
+
+    shared by every texture whose entry hasn't moved, so a refresh can point
+    all of them at a newer read of the file at once.
+    """
+
+    texture_cache_file: BytesIO
+
+    def __init__(self, texture_cache_file: BytesIO):
+        self.texture_cache_file = texture_cache_file
 
 
 class Texture(Entry):
     index: int
-    body_path: Path
+    cache_dir: Path
+    generation: int
+    """The refresh of the cache this texture was read in"""
+    heads: HeadBuffer | None
     loads: Callable[[], bytes]
     """Open texture as a bytes object"""
 
@@ -39,19 +63,54 @@ class Texture(Entry):
         *,
         index: int,
         entry: Entry,
-        body_path: Path,
-        loads: Callable[[], bytes],
+        loads: Callable[[], bytes] | None = None,
+        heads: HeadBuffer | None = None,
+        body_path: Path | None = None,
+        cache_dir: Path | None = None,
+        generation: int = 0,
     ):
-        super().__init__(**entry.__dict__)
+        super().__init__(entry.uuid, entry.image_size, entry.body_size, entry.time)
+
+        if loads is None and heads is None:
+            raise ValueError("either loads or heads is required")
+
+        if body_path is not None:
+            self.body_path = body_path
+            # body_path is <cache_dir>/<subdir>/<uuid>.texture
+            self.cache_dir = body_path.parent.parent
+        elif cache_dir is not None:
+            self.cache_dir = cache_dir
+        else:
+            raise ValueError("either body_path or cache_dir is required")
 
         self.index = index
-        self.body_path = body_path
-        self.loads = loads
+        self.heads = heads
+        # a bound method rather than a closure per texture keeps building large
+        # caches cheap, mostly by giving the garbage collector less to track
+        self.loads = loads if loads is not None else self.read_bytes
+        self.generation = generation
+
+    @cached_property
+    def body_path(self) -> Path:
+        # joining paths dominates building textures for large caches, so only
+        # do it for the textures whose body is actually looked at
+        return texture_location(self.cache_dir, self.uuid)
 
     def __repr__(self) -> str:
         size = format_bytes(self.image_size) if not self.is_empty else "empty"
         return f"<Texture {self.uuid}, {self.time}, {size}, is_downloaded={self.is_downloaded()}>"
 
+    def read_bytes(self) -> bytes:
+        """Read the texture from its head in texture.cache and its body file"""
+
+        assert self.heads is not None
+        head = read_texture_cache(self.heads.texture_cache_file, self.index)
+
+        if self.is_head_only:
+            return head
+
+        return head + read_texture_body(self.body_path)
+
     def is_downloaded(self) -> bool:
         """Check if the texture file is fully downloaded"""
         return self.fs_size() == self.image_size
@@ -72,18 +131,78 @@ class Texture(Entry):
         b = self.loads()
         return Image.open(BytesIO(b), formats=["jpeg2000"])
 
+    def salvage(self) -> Salvaged | None:
+        """
+        Cut a partially downloaded texture down to the packets that are complete,
+        or None if not even the lowest resolution level has arrived yet
+        """
+
+        try:
+            return salvage_codestream(self.loads())
+        except FileNotFoundError:
+            return None
+
+    def open_partial_image(self) -> Image.Image | None:
+        """Open the complete resolution levels of a partially downloaded texture as a pillow image"""
+
+        salvaged = self.salvage()
+
+        if salvaged is None:
+            return None
+
+        # pillow rounds reduced sizes differently from openjpeg for some odd
+        # dimensions and then fails to decode, so fall back to coarser levels
+        for reduce in range(salvaged.reduce, salvaged.max_reduce + 1):
+            im = Image.open(BytesIO(salvaged.codestream), formats=["jpeg2000"])
+            setattr(im, "reduce", reduce)
+            # don't let the decoder use layers that are only partially there
+            setattr(im, "layers", salvaged.layers)
+
+            if reduce == 0:
+                # pillow only passes layers on to the decoder along with reduce.
+                # tiles are plain tuples before pillow 11, so index them by position
+                setattr(im, "tile", [
+                    (*tile[:3], (*tile[3][:2], salvaged.layers, *tile[3][3:]))
+                    for tile in getattr(im, "tile")
+                ])
+
+            try:
+                im.load()
+                return im
+            except OSError:
+                im.close()
+
+        return None
+
 
 class TextureCache:
     cache_dir: Path
     texture_entries_file: BytesIO
     texture_cache_file: BytesIO
+    texture_cache_signature: tuple[int, int] | None
+    """Size and mtime of the texture.cache file read in the last refresh"""
+    heads: HeadBuffer
 
     header: Header
-    entries: list[Entry] = []
-    textures: dict[str, Texture] = {}
-
-    def __init__(self, cache_dir: str | Path):
+    entries: list[Entry]
+    textures: dict[str, Texture]
+    generation: int
+    """Incremented every time a refresh reads a new revision of the cache"""
+    entries_key: EntriesKey | None
+    snapshot_path: Path | None
+    changes_since_snapshot: list[Texture]
+    """Textures that changed between the loaded snapshot and the first refresh"""
+
+    def __init__(self, cache_dir: str | Path, *, snapshot_path: str | Path | None = None):
         self.cache_dir = Path(cache_dir)
+        self.entries = []
+        self.textures = {}
+        self.generation = 0
+        self.entries_key = None
+        self.texture_cache_signature = None
+        self.heads = HeadBuffer(BytesIO())
+        self.snapshot_path = Path(snapshot_path) if snapshot_path is not None else None
+        self.changes_since_snapshot = []
 
         if (
             not self.cache_dir.is_dir()
@@ -92,7 +211,17 @@ class TextureCache:
         ):
             raise FileNotFoundError("path does not contain a proper texture cache")
 
-        self.refresh()
+        snapshot = (
+            read_snapshot(self.snapshot_path, self.cache_dir)
+            if self.snapshot_path is not None
+            else None
+        )
+
+        if snapshot is not None:
+            self.__load_snapshot(snapshot)
+            self.changes_since_snapshot = list(self.refresh())
+        else:
+            self.refresh()
 
     def __iter__(self) -> Iterator[Texture]:
         return iter(self.textures.values())
@@ -103,6 +232,25 @@ class TextureCache:
     def __len__(self) -> int:
         return len(self.textures)
 
+    def shard(self, k: int, n: int) -> Iterator[Texture]:
+        """
+        Iterate over shard k of n (counting from 1).
+
+        textures are partitioned by uuid, so the union of all n shards covers
+        every texture exactly once, even if the cache is refreshed in between.
+        """
+
+        shard = Shard(k, n)
+
+        if not 1 <= k <= n:
+            raise ValueError(f"invalid shard {shard}")
+
+        return (texture for texture in self if shard.includes(texture.uuid))
+
+    def plan(self, textures: Iterable[Texture] | None = None) -> list[Texture]:
+        """Order textures (by default, all of them) for sequential disk access"""
+        return plan_extraction(self.cache_dir, self if textures is None else textures)
+
     def __repr__(self) -> str:
         total_size = sum(texture.image_size for texture in self)
 
@@ -112,63 +260,161 @@ class TextureCache:
             f"{format_bytes(total_size)}>"
         )
 
-    def __get_read_bytes(self, i: int, entry: Entry) -> Callable[[], bytes]:
-        def read_bytes() -> bytes:
-            head = read_texture_cache(self.texture_cache_file, i)
+    def __make_texture(self, i: int, entry: Entry) -> Texture:
+        return Texture(
+            index=i,
+            entry=entry,
+            heads=self.heads,
+            cache_dir=self.cache_dir,
+            generation=self.generation,
+        )
 
-            if entry.image_size <= 601 and entry.body_size == 0:
-                # sometimes the file is smaller than 600 bytes, so using the head is
-                # sufficient
-                return head
-            else:
-                path = texture_location(self.cache_dir, entry.uuid)
-                body = read_texture_body(path)
+    def __load_snapshot(self, snapshot: Snapshot) -> None:
+        # textures are only built by the first refresh, which diffs against these
+        self.entries_key = snapshot.key
+        self.header = snapshot.header
+        self.entries = snapshot.entries
+
+    def is_stale(self, texture: Texture) -> bool:
+        """Check if a texture has changed or disappeared since it was read, so work on it can be dropped"""
+        return texture.generation != self.generation and texture != self.get(texture.uuid)
+
+    def save_snapshot(self, path: str | Path | None = None) -> None:
+        """Persist the decoded entry table so the next session can start warm"""
 
-                return head + body
+        path = Path(path) if path is not None else self.snapshot_path
 
-        return read_bytes
+        if path is None:
+            raise ValueError("no snapshot path given")
+
+        if self.entries_key is None:
+            return
+
+        write_snapshot(
+            path,
+            self.cache_dir,
+            Snapshot(key=self.entries_key, header=self.header, entries=self.entries),
+        )
 
     def refresh(self) -> Iterator[Texture]:
         old_entry_count = self.header.entry_count if hasattr(self, "header") else 0
+        old_entries = {entry.uuid: entry for entry in self.entries}
 
-        self.texture_entries_file = loads_bytes_io(self.cache_dir / "texture.entries")
-        self.texture_cache_file = loads_bytes_io(self.cache_dir / "texture.cache")
-        self.header = Header.from_texture_entries(self.texture_entries_file)
+        files = read_cache_files(self.cache_dir)
+        entries_key = EntriesKey.from_stat(files.texture_entries_stat, files.texture_entries)
+        texture_cache_signature = (files.texture_cache_stat.st_size, files.texture_cache_stat.st_mtime_ns)
 
-        self.entries = decode_texture_entries(
-            self.texture_entries_file,
-            entry_count=self.header.entry_count,
-        )
+        if (
+            entries_key == self.entries_key
+            and texture_cache_signature == self.texture_cache_signature
+            and self.textures
+        ):
+            # both files are exactly what we already read
+            return iter([])
+
+        self.texture_entries_file = files.texture_entries
+        self.texture_cache_file = files.texture_cache
+        self.texture_cache_signature = texture_cache_signature
+        self.generation += 1
+
+        if entries_key != self.entries_key:
+            self.header = files.header
+            self.entries = decode_texture_entries(
+                self.texture_entries_file,
+                entry_count=self.header.entry_count,
+            )
+            self.entries_key = entries_key
 
         if self.header.entry_count < old_entry_count:
             # the cache was cleared
-            self.textures = {}
+            old_entries = {}
+
+        old_textures = self.textures
+        textures: dict[str, Texture] = {}
+        changed_textures: list[Texture] = []
+
+        old_heads = self.heads.texture_cache_file.getvalue()
+        new_heads = files.texture_cache.getvalue()
+        same_heads = old_heads == new_heads
+
+        def head_changed(i: int, entry: Entry, texture: Texture | None) -> bool:
+            # the viewer may write an entry before its head, so a texture read
+            # from a head that wasn't there yet is reported again once it lands
+            if entry.is_empty:
+                return False
 
-        changed_textures: dict[str, Texture] = {}
+            start = i * TEXTURE_CACHE_BYTE_COUNT
+            head = new_heads[start:start + TEXTURE_CACHE_BYTE_COUNT]
+
+            if not head.startswith(JPEG2000_SOC):
+                return True
+
+            if same_heads or texture is None:
+                return False
+
+            old_start = texture.index * TEXTURE_CACHE_BYTE_COUNT
+            return head != old_heads[old_start:old_start + TEXTURE_CACHE_BYTE_COUNT]
 
         for i, entry in enumerate(self.entries):
-            if entry != self.get(entry.uuid, None):
-                changed_textures[entry.uuid] = Texture(
-                    index=i,
-                    entry=entry,
-                    loads=self.__get_read_bytes(i, entry),
-                    body_path=texture_location(self.cache_dir, entry.uuid),
-                )
+            texture = old_textures.get(entry.uuid)
+            changed = entry != old_entries.get(entry.uuid) or head_changed(i, entry, texture)
+
+            # only textures that are new or have moved need new objects
+            if changed or texture is None or texture.index != i or texture.image_size != entry.image_size:
+                texture = self.__make_texture(i, entry)
+
+            textures[entry.uuid] = texture
 
-        self.textures |= changed_textures
+            if changed:
+                changed_textures.append(texture)
 
-        return iter(changed_textures.values())
+        # textures that left the table keep reading the texture.cache of their
+        # own revision, so their slot can't hand them another entry's head
+        dropped = [
+            texture
+            for uuid, texture in old_textures.items()
+            if textures.get(uuid) is not texture
+        ]
 
-    def watch(self, handler: Callable[[list[Texture]], Any]) -> BaseObserver:
-        """Watch the cache directory for changes and call the handler function on updates."""
+        if dropped:
+            frozen = HeadBuffer(self.heads.texture_cache_file)
+
+            for texture in dropped:
+                texture.heads = frozen
+
+        self.heads.texture_cache_file = files.texture_cache
+        self.textures = textures
+
+        return iter(changed_textures)
+
+    def watch(
+        self,
+        handler: Callable[[list[Texture]], Any],
+        *,
+        on_refresh: Callable[[float], Any] | None = None,
+    ) -> BaseObserver:
+        """
+        Watch the cache directory for changes and call the handler function on updates.
+
+        on_refresh, if given, is called with the duration in seconds of every refresh.
+        """
 
         def on_modified(event: DirModifiedEvent | FileModifiedEvent) -> None:
-            changed_textures = list(self.refresh())
+            start = time.perf_counter()
+
+            try:
+                changed_textures = list(self.refresh())
+            except InconsistentCacheError:
+                # the viewer is still writing, the next modification will catch up
+                return
+
+            if on_refresh is not None:
+                on_refresh(time.perf_counter() - start)
 
             if changed_textures:
                 handler(changed_textures)
 
-        event_handler = PatternMatchingEventHandler(patterns=["texture.entries"])
+        event_handler = PatternMatchingEventHandler(patterns=["texture.entries", "texture.cache"])
         setattr(event_handler, "on_modified", on_modified)
 
         observer = Observer()
@@ -179,3 +425,56 @@ class TextureCache:
 
     def get(self, uuid: str, default: Optional[T] = None) -> Texture | T:
         return self.textures.get(uuid, default)  # type: ignore
+
+
+def newest_textures(caches: Iterable[TextureCache]) -> list[Texture]:
+    """
+    Merge the textures of several caches, keeping the best copy of each.
+
+    a complete copy beats an empty or partially downloaded one, even if it was
+    cached longer ago. the most recently cached copy wins among equals.
+    """
+
+    Rank = tuple[bool, bool, datetime]
+    best: dict[str, tuple[Rank | None, Texture]] = {}
+
+    def rank(texture: Texture) -> Rank:
+        return (not texture.is_empty, texture.is_downloaded(), texture.time)
+
+    for cache in caches:
+        for texture in cache:
+            current = best.get(texture.uuid)
+
+            if current is None:
+                # checking the body on disk is only worth it for duplicates
+                best[texture.uuid] = (None, texture)
+                continue
+
+            current_rank, current_texture = current
+
+            if current_rank is None:
+                current_rank = rank(current_texture)
+
+            texture_rank = rank(texture)
+
+            if texture_rank > current_rank:
+                best[texture.uuid] = (texture_rank, texture)
+            else:
+                best[texture.uuid] = (current_rank, current_texture)
+
+    return [texture for _, texture in best.values()]
+
+
+def plan_textures(textures: Iterable[Texture]) -> list[Texture]:
+    """Like TextureCache.plan, for textures that may come from several caches"""
+
+    by_cache_dir: dict[Path, list[Texture]] = {}
+
+    for texture in textures:
+        by_cache_dir.setdefault(texture.cache_dir, []).append(texture)
+
+    return [
+        texture
+        for cache_dir, group in by_cache_dir.items()
+        for texture in plan_extraction(cache_dir, group)
+    ]
@@ -1,15 +1,27 @@
 import argparse
 from pathlib import Path
 import sys
+import time
 from typing import Literal
 from tqdm import tqdm
 import os
 
 from .signal import interrupthandler
-from .api import Texture, TextureCache
+from .api import Texture, TextureCache, newest_textures, plan_textures
+from .core import InconsistentCacheError
 from .find import find_texturecache, list_texture_caches
+from .metrics import METRICS_INTERVAL, WatchMetrics
+from .shard import (
+    PROGRESS_INTERVAL,
+    Shard,
+    ShardSummary,
+    merge_shard_summaries,
+    read_shard_summaries,
+    write_shard_summary,
+)
 
 OutputMode = Literal["progress", "files", "debug"]
+Order = Literal["locality", "entry"]
 
 
 class TextureError(Exception):
@@ -31,6 +43,13 @@ class Args(argparse.Namespace):
     force: bool
     raw: bool
     skip_integrity: bool
+    salvage: bool
+    all_caches: bool
+    snapshot: Path | None
+    shard: Shard | None
+    merge_shards: bool
+    metrics_file: Path | None
+    order: Order
 
 
 def clear_screen() -> None:
@@ -93,6 +112,14 @@ def parse_args() -> Args:
     parser.add_argument(
         "cache_dir", type=Path, nargs="?", help="path to texture cache directory"
     )
+    parser.add_argument(
+        "--all-caches",
+        "-a",
+        action="store_true",
+        help="extract every texture cache found on the system in one run, "
+        "keeping the newest copy of textures found in several caches",
+        default=False,
+    )
     parser.add_argument(
         "--output-dir",
         "-o",
@@ -109,6 +136,14 @@ def parse_args() -> Args:
         default="progress",
     )
 
+    parser.add_argument(
+        "--order",
+        choices=("locality", "entry"),
+        help="order to extract textures in. 'locality' groups reads by their place on disk, "
+        "'entry' follows the order of the cache's entry table",
+        default="locality",
+    )
+
     parser.add_argument(
         "--watch",
         "-w",
@@ -117,6 +152,13 @@ def parse_args() -> Args:
         default=False,
     )
 
+    parser.add_argument(
+        "--metrics-file",
+        type=Path,
+        help="in watch mode, keep a prometheus textfile with extraction metrics at this path",
+        default=None,
+    )
+
     parser.add_argument(
         "--force",
         "-f",
@@ -139,18 +181,88 @@ def parse_args() -> Args:
         default=False,
     )
 
+    parser.add_argument(
+        "--salvage",
+        action="store_true",
+        help="save incomplete textures at the highest resolution that has fully downloaded, "
+        "tagged with a .partial suffix",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--snapshot",
+        type=Path,
+        help="path to a parse snapshot of the cache, used for faster warm starts. "
+        "in watch mode, changes made since the last session are also extracted",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--shard",
+        type=Shard.parse,
+        metavar="K/N",
+        help="only extract shard K of N, partitioned by texture uuid. "
+        "each shard writes a summary to the output directory",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--merge-shards",
+        action="store_true",
+        help="print a combined report from the shard summaries in the output directory",
+        default=False,
+    )
+
     args = Args()
     parser.parse_args(namespace=args)
 
     return args
 
 
+def save_partial_texture(texture: Texture, output_dir: Path, args: Args) -> Path:
+    if (output_dir / f"{texture.uuid}.{'j2c' if args.raw else 'jp2'}").exists() and not args.force:
+        raise FileExistsError
+
+    # partial textures are provisional, so they are overwritten as more of the
+    # texture arrives
+    if args.raw is False:
+        save_path = output_dir / f"{texture.uuid}.partial.jp2"
+        im = texture.open_partial_image()
+
+        if im is None:
+            raise TextureIncompleteError
+
+        with im:
+            im.save(save_path)
+    else:
+        save_path = output_dir / f"{texture.uuid}.partial.j2c"
+        salvaged = texture.salvage()
+
+        if salvaged is None:
+            raise TextureIncompleteError
+
+        save_path.write_bytes(salvaged.codestream)
+
+    os.utime(save_path, (texture.time.timestamp(), texture.time.timestamp()))
+
+    return save_path
+
+
+def is_partial(save_path: Path) -> bool:
+    """Check if an exported file is a salvaged partial texture"""
+    return save_path.suffixes[-2:-1] == [".partial"]
+
+
 def save_texture(texture: Texture, output_dir: Path, args: Args) -> Path:
     if texture.is_empty:
         raise TextureEmptyError
 
-    if texture.is_downloaded() is False and not args.skip_integrity:
-        raise TextureIncompleteError
+    if texture.is_downloaded() is False:
+        if args.salvage:
+            return save_partial_texture(texture, output_dir, args)
+
+        if not args.skip_integrity:
+            raise TextureIncompleteError
 
     if args.raw is False:
         save_path = output_dir / f"{texture.uuid}.jp2"
@@ -176,6 +288,9 @@ def save_texture(texture: Texture, output_dir: Path, args: Args) -> Path:
     # (atime, mtime)
     os.utime(save_path, (texture.time.timestamp(), texture.time.timestamp()))
 
+    # the full texture supersedes anything salvaged earlier
+    save_path.with_suffix(f".partial{save_path.suffix}").unlink(missing_ok=True)
+
     return save_path
 
 
@@ -194,6 +309,7 @@ def end(
     *,
     args: Args,
     good_writes: int,
+    partial_writes: int,
     existing_textures: int,
     incomplete_textures: int,
     error_write_textures: int,
@@ -202,6 +318,9 @@ def end(
     if args.output_mode in ("progress", "debug"):
         s = [f"wrote {good_writes} textures to {args.output_dir.resolve()}"]
 
+        if partial_writes:
+            s.append(f"wrote {partial_writes} partial textures")
+
         if existing_textures:
             s.append(f"skipped {existing_textures} existing textures")
 
@@ -217,31 +336,111 @@ def end(
         print_text_frame(s)
 
 
+def write_shard_progress(args: Args, summary: ShardSummary) -> None:
+    # progress is best effort, a failed write must not stop the extraction
+    try:
+        write_shard_summary(args.output_dir, summary)
+    except OSError as e:
+        if args.output_mode == "debug":
+            print(f"error writing shard summary: {e}")
+
+
+def write_final_shard_summary(args: Args, summary: ShardSummary) -> None:
+    # still print the report if shared storage fails us at the very end
+    try:
+        write_shard_summary(args.output_dir, summary)
+    except OSError as e:
+        print(f"error: could not write shard summary: {e}")
+
+
+def merge_shards(args: Args) -> None:
+    try:
+        summary = merge_shard_summaries(read_shard_summaries(args.output_dir))
+    except (OSError, ValueError) as e:
+        print(f"error: could not merge shards: {e}")
+        sys.exit(1)
+
+    end(
+        args=args,
+        good_writes=summary.good_writes,
+        partial_writes=summary.partial_writes,
+        existing_textures=summary.existing_textures,
+        incomplete_textures=summary.incomplete_textures,
+        error_write_textures=summary.error_write_textures,
+        empty_textures=summary.empty_textures,
+    )
+
+    if not summary.complete:
+        print("warning: some shards did not run to completion")
+
+
 def main() -> None:
     args = parse_args()
 
-    if args.cache_dir:
+    if args.merge_shards:
+        merge_shards(args)
+        return
+
+    if args.all_caches:
+        if args.cache_dir:
+            print("error: --all-caches can't be combined with a cache directory")
+            sys.exit(1)
+
+        if args.watch or args.snapshot:
+            print("error: --all-caches can't be combined with --watch or --snapshot")
+            sys.exit(1)
+
+        try:
+            # the same cache can be reachable through several roots
+            cache_dirs = list(dict.fromkeys(path.resolve() for path in list_texture_caches()))
+        except FileNotFoundError:
+            print("error: no cache found")
+            sys.exit(1)
+    elif args.cache_dir:
         cache_dir = find_texturecache(args.cache_dir)
 
         if cache_dir is None:
             print(f"error: no texture cache found at {args.cache_dir.resolve()}")
             sys.exit(1)
+
+        cache_dirs = [cache_dir]
     else:
         if args.output_mode == "files":
             print("error: output mode 'files' requires a cache directory")
             sys.exit(1)
 
-        cache_dir = prompt_for_cache_dir()
+        cache_dirs = [prompt_for_cache_dir()]
+
+    if args.all_caches:
+        caches: list[TextureCache] = []
+
+        for cache_dir in cache_dirs:
+            # one broken viewer cache shouldn't hold up all the others
+            try:
+                caches.append(TextureCache(cache_dir))
+            except (OSError, InconsistentCacheError) as e:
+                print(f"warning: skipping cache at {cache_dir}: {e}")
+
+        if not caches:
+            print("error: no readable cache found")
+            sys.exit(1)
+    else:
+        try:
+            caches = [TextureCache(cache_dirs[0], snapshot_path=args.snapshot)]
+        except InconsistentCacheError as e:
+            print(f"error: {e}, is the viewer still writing to it?")
+            sys.exit(1)
 
-    cache = TextureCache(cache_dir)
+    cache = caches[0]
     good_writes = 0
 
     if args.output_mode == "debug":
-        print("")
-        print("TEXTURE ENTRIES HEADER:")
+        for c in caches:
+            print("")
+            print(f"TEXTURE ENTRIES HEADER ({c.cache_dir.resolve()}):")
 
-        for k, v in cache.header:
-            print(f"{k}: {v}")
+            for k, v in c.header:
+                print(f"{k}: {v}")
 
     args.output_dir.mkdir(exist_ok=True)
 
@@ -250,11 +449,62 @@ def main() -> None:
         failed_stack: set[str] = set()
         empty_stack: set[str] = set()
         existing_stack: set[str] = set()
+        partial_stack: set[str] = set()
+        metrics = WatchMetrics()
+
+        def shard_summary(*, complete: bool) -> ShardSummary:
+            assert args.shard
+
+            return ShardSummary(
+                shard=args.shard,
+                complete=complete,
+                good_writes=good_writes,
+                partial_writes=len(partial_stack),
+                existing_textures=len(existing_stack),
+                incomplete_textures=len(incomplete_stack),
+                error_write_textures=len(failed_stack),
+                empty_textures=len(empty_stack),
+            )
+
+        def write_metrics() -> None:
+            if args.metrics_file:
+                try:
+                    metrics.write(args.metrics_file)
+                except OSError as e:
+                    if args.output_mode == "debug":
+                        print(f"error writing metrics: {e}")
+
+        def on_refresh(seconds: float) -> None:
+            metrics.observe_refresh(seconds)
+            write_metrics()
+
+        def observe_export(texture: Texture, save_path: Path) -> None:
+            # measured apart from the write, which has already been counted
+            try:
+                size = save_path.stat().st_size
+            except OSError:
+                return
+
+            metrics.observe_export(latency=time.time() - texture.time.timestamp(), size=size)
 
         def handler(modified_textures: list[Texture]) -> None:
             nonlocal good_writes
 
-            for texture in modified_textures:
+            # the whole batch is waiting now, so show it before working through it
+            metrics.set_queue_depth(len(modified_textures))
+            write_metrics()
+            last_metrics_write = time.monotonic()
+
+            for i, texture in enumerate(modified_textures):
+                metrics.set_queue_depth(len(modified_textures) - i)
+
+                if time.monotonic() - last_metrics_write >= METRICS_INTERVAL:
+                    write_metrics()
+                    last_metrics_write = time.monotonic()
+
+                if args.shard and not args.shard.includes(texture.uuid):
+                    continue
+
                 save_path: Path | None = None
 
                 try:
@@ -264,26 +514,43 @@ def main() -> None:
                         args=args,
                     )
 
-                    good_writes += 1
                     empty_stack.discard(texture.uuid)
                     failed_stack.discard(texture.uuid)
                     incomplete_stack.discard(texture.uuid)
+
+                    if is_partial(save_path):
+                        partial_stack.add(texture.uuid)
+                        metrics.count("partial")
+                    else:
+                        good_writes += 1
+                        partial_stack.discard(texture.uuid)
+                        metrics.count("written")
                 except TextureEmptyError:
                     empty_stack.add(texture.uuid)
+                    metrics.count("empty")
                 except FileExistsError:
                     existing_stack.add(texture.uuid)
                     failed_stack.discard(texture.uuid)
+                    metrics.count("existing")
                 except TextureIncompleteError:
                     incomplete_stack.add(texture.uuid)
+                    metrics.count("incomplete")
                 except OSError as e:
                     failed_stack.add(texture.uuid)
+                    metrics.count("failed")
 
                     if args.output_mode == "debug":
                         print(f"error writing {texture.uuid}: {e}")
 
+                if save_path:
+                    observe_export(texture, save_path)
+
                 if args.output_mode == "progress":
                     printstr = [f"{good_writes} textures extracted"]
 
+                    if len(partial_stack):
+                        printstr.append(f"{len(partial_stack)} partial")
+
                     if len(incomplete_stack):
                         printstr.append(f"{len(incomplete_stack)} incomplete")
 
@@ -301,7 +568,11 @@ def main() -> None:
                 if args.output_mode in ("files", "debug") and save_path:
                     print(save_path.resolve())
 
-        observer = cache.watch(handler)
+            metrics.set_queue_depth(0)
+            write_metrics()
+
+            if args.shard:
+                write_shard_progress(args, shard_summary(complete=False))
 
         clear_screen()
 
@@ -312,6 +583,13 @@ def main() -> None:
             print("input ctrl+c or ctrl+d to stop")
             print("")
 
+        if cache.changes_since_snapshot:
+            # pick up whatever changed while we weren't watching
+            handler(cache.changes_since_snapshot)
+
+        write_metrics()
+        observer = cache.watch(handler, on_refresh=on_refresh)
+
         with interrupthandler() as h:
             try:
                 while observer.is_alive() and not h.interrupted:
@@ -322,9 +600,18 @@ def main() -> None:
                 observer.stop()
                 observer.join()
 
+            if args.snapshot:
+                cache.save_snapshot()
+
+            write_metrics()
+
+            if args.shard:
+                write_final_shard_summary(args, shard_summary(complete=False))
+
             end(
                 args=args,
                 good_writes=good_writes,
+                partial_writes=len(partial_stack),
                 existing_textures=len(existing_stack),
                 incomplete_textures=len(incomplete_stack),
                 error_write_textures=len(failed_stack),
@@ -334,27 +621,61 @@ def main() -> None:
             sys.exit(130)
 
     else:
+        partial_writes = 0
         empty_textures = 0
         error_write_textures = 0
         incomplete_textures = 0
         existing_textures = 0
 
+        # one work queue across every cache, without duplicate textures
+        textures = newest_textures(caches)
+
+        if args.shard:
+            textures = [texture for texture in textures if args.shard.includes(texture.uuid)]
+
+        if args.order == "locality":
+            textures = plan_textures(textures)
+
+        def shard_summary(*, complete: bool) -> ShardSummary:
+            assert args.shard
+
+            return ShardSummary(
+                shard=args.shard,
+                complete=complete,
+                good_writes=good_writes,
+                partial_writes=partial_writes,
+                existing_textures=existing_textures,
+                incomplete_textures=incomplete_textures,
+                error_write_textures=error_write_textures,
+                empty_textures=empty_textures,
+            )
+
+        if args.shard:
+            # leave a summary behind even if this shard never finishes
+            write_shard_progress(args, shard_summary(complete=False))
+
+        last_progress = time.monotonic()
+
     with interrupthandler() as h:
         with tqdm(
-            total=cache.header.entry_count,
+            total=len(textures),
             desc="extracting textures",
             unit="tex",
             delay=1,
             disable=args.output_mode != "progress",
         ) as progress:
-            for texture in cache:
+            for texture in textures:
                 if h.interrupted:
                     progress.close()
                     break
 
                 try:
                     save_path = save_texture(texture, output_dir=args.output_dir, args=args)
-                    good_writes += 1
+
+                    if is_partial(save_path):
+                        partial_writes += 1
+                    else:
+                        good_writes += 1
 
                     if args.output_mode in ("files", "debug"):
                         print(save_path.resolve())
@@ -369,6 +690,7 @@ def main() -> None:
 
                 postfix = {
                     "ok": good_writes,
+                    "partial": partial_writes,
                     "existing": existing_textures,
                     "incomplete": incomplete_textures,
                     "error": error_write_textures,
@@ -378,15 +700,26 @@ def main() -> None:
                 progress.update()
                 progress.set_postfix({k: v for k, v in postfix.items() if v})
 
+                if args.shard and time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                    write_shard_progress(args, shard_summary(complete=False))
+                    last_progress = time.monotonic()
+
+            if args.snapshot and not h.interrupted:
+                cache.save_snapshot()
+
+            if args.shard:
+                write_final_shard_summary(args, shard_summary(complete=not h.interrupted))
+
             end(
                 args=args,
                 good_writes=good_writes,
+                partial_writes=partial_writes,
                 incomplete_textures=incomplete_textures,
                 existing_textures=existing_textures,
                 error_write_textures=error_write_textures,
                 empty_textures=empty_textures,
             )
 
-            if args.output_mode == "files" and good_writes == 0:
+            if args.output_mode == "files" and good_writes == 0 and partial_writes == 0:
                 print("warning: no textures were written")
                 sys.exit(73)
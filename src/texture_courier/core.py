@@ -1,9 +1,11 @@
 from datetime import datetime
 from io import BytesIO
+import os
 from pathlib import Path
 import struct
+import time
 from uuid import UUID
-from typing import Any, Iterator, Self
+from typing import Any, Iterator, NamedTuple, Self
 
 from .util import format_bytes
 
@@ -14,6 +16,14 @@ ENTRY_STRUCT_FORMAT = "16BiiI"
 ENTRY_BYTE_COUNT = 28
 
 TEXTURE_CACHE_BYTE_COUNT = 600
+JPEG2000_SOC = b"\xff\x4f"
+
+READ_ATTEMPTS = 5
+READ_BACKOFF = 0.05
+
+
+class InconsistentCacheError(Exception):
+    """The cache files kept changing while they were being read"""
 
 
 class Header:
@@ -82,6 +92,12 @@ class Entry:
     def is_empty(self) -> bool:
         return self.image_size <= 0
 
+    @property
+    def is_head_only(self) -> bool:
+        # sometimes the file is smaller than 600 bytes, so the head in
+        # texture.cache holds all of it and there is no body file
+        return self.image_size <= 601 and self.body_size == 0
+
     @classmethod
     def from_bytes(cls, b: bytes) -> Self:
         unpack = struct.unpack(ENTRY_STRUCT_FORMAT, b)
@@ -118,14 +134,77 @@ def decode_texture_entries(texture_entries: BytesIO, entry_count: int) -> list[E
 
 
 def read_texture_cache(texture_cache: BytesIO, n: int) -> bytes:
-    try:
-        texture_cache.seek(TEXTURE_CACHE_BYTE_COUNT * n)
-        return texture_cache.read(TEXTURE_CACHE_BYTE_COUNT)
-    except OSError:
-        raise Exception(
-            f"failed to read from texture cache at {TEXTURE_CACHE_BYTE_COUNT * n}"
+    # slice the underlying buffer rather than seek + read, so concurrent readers
+    # sharing one BytesIO don't move the cursor out from under each other
+    start = TEXTURE_CACHE_BYTE_COUNT * n
+
+    with texture_cache.getbuffer() as view:
+        return bytes(view[start:start + TEXTURE_CACHE_BYTE_COUNT])
+
+
+class CacheFiles(NamedTuple):
+    texture_entries: BytesIO
+    texture_cache: BytesIO
+    header: Header
+    texture_entries_stat: os.stat_result
+    texture_cache_stat: os.stat_result
+
+
+def file_signature(path: Path) -> tuple[int, int]:
+    stat = path.stat()
+    return stat.st_size, stat.st_mtime_ns
+
+
+def read_cache_files(
+    cache_dir: Path,
+    *,
+    attempts: int = READ_ATTEMPTS,
+    backoff: float = READ_BACKOFF,
+) -> CacheFiles:
+    """
+    Read texture.entries and texture.cache as one consistent snapshot.
+
+    the viewer may be writing to either file while we read them, so the size and
+    mtime of both are compared before and after reading, and the declared entry
+    count is checked against the length of texture.entries. torn reads are
+    retried with exponential backoff.
+    """
+
+    entries_path = cache_dir / "texture.entries"
+    cache_path = cache_dir / "texture.cache"
+
+    for attempt in range(attempts):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+
+        before = (file_signature(entries_path), file_signature(cache_path))
+        texture_entries = BytesIO(entries_path.read_bytes())
+        texture_cache = BytesIO(cache_path.read_bytes())
+        texture_entries_stat = entries_path.stat()
+        texture_cache_stat = cache_path.stat()
+        after = (
+            (texture_entries_stat.st_size, texture_entries_stat.st_mtime_ns),
+            (texture_cache_stat.st_size, texture_cache_stat.st_mtime_ns),
         )
 
+        if before != after:
+            continue
+
+        if len(texture_entries.getbuffer()) < HEADER_BYTE_COUNT:
+            continue
+
+        header = Header.from_texture_entries(texture_entries)
+        needed = HEADER_BYTE_COUNT + header.entry_count * ENTRY_BYTE_COUNT
+
+        if len(texture_entries.getbuffer()) < needed:
+            continue
+
+        return CacheFiles(
+            texture_entries, texture_cache, header, texture_entries_stat, texture_cache_stat
+        )
+
+    raise InconsistentCacheError(f"cache at {cache_dir} kept changing after {attempts} reads")
+
 
 def texture_location(cache_dir: Path, uuid: str) -> Path:
     subdir = uuid[0]
@@ -0,0 +1,730 @@
+"""
+Just enough of a JPEG 2000 codestream parser (ITU-T T.800) to work out which
+resolution levels of a truncated texture are fully downloaded.
+
+the viewer fetches textures progressively, so an incomplete texture is a
+prefix of a valid codestream. walking the packet headers tells us where each
+packet ends, and therefore which resolution levels are complete.
+"""
+
+import struct
+from typing import Iterator, NamedTuple
+
+SOT = 0xFF90
+SOD = 0xFF93
+SIZ = 0xFF51
+COD = 0xFF52
+COC = 0xFF53
+POC = 0xFF5F
+PPM = 0xFF60
+PPT = 0xFF61
+
+LRCP, RLCP, RPCL, PCRL, CPRL = range(5)
+
+CBLKSTY_LAZY = 0x01
+CBLKSTY_TERMALL = 0x04
+
+
+class Salvaged(NamedTuple):
+    codestream: bytes
+    """Valid codestream made of every complete packet"""
+    reduce: int
+    """Number of resolution levels to discard when decoding"""
+    layers: int
+    """Number of quality layers complete at that resolution"""
+    max_reduce: int
+    """Most resolution levels that can be discarded"""
+
+
+class UnsupportedCodestream(Exception):
+    pass
+
+
+class Truncated(Exception):
+    pass
+
+
+def ceildiv(a: int, b: int) -> int:
+    return -(-a // b)
+
+
+def ceildivpow2(a: int, b: int) -> int:
+    return -(-a >> b)
+
+
+class CodingStyle:
+    progression: int
+    layers: int
+    use_sop: bool
+    use_eph: bool
+    levels: int
+    cblkw: int
+    cblkh: int
+    cblksty: int
+    precincts: list[tuple[int, int]]
+
+    def __init__(self, scod: int, progression: int, layers: int, spcod: bytes):
+        self.progression = progression
+        self.layers = layers
+        self.use_sop = bool(scod & 0x02)
+        self.use_eph = bool(scod & 0x04)
+        self.set_component_style(scod, spcod)
+
+    def set_component_style(self, scod: int, spcod: bytes) -> None:
+        self.levels = spcod[0]
+        self.cblkw = spcod[1] + 2
+        self.cblkh = spcod[2] + 2
+        self.cblksty = spcod[3]
+
+        if scod & 0x01:
+            self.precincts = [(b & 0x0F, b >> 4) for b in spcod[5:5 + self.levels + 1]]
+        else:
+            self.precincts = [(15, 15)] * (self.levels + 1)
+
+        if len(self.precincts) != self.levels + 1:
+            raise Truncated
+
+    def copy(self) -> "CodingStyle":
+        c = object.__new__(CodingStyle)
+        c.__dict__.update(self.__dict__)
+        return c
+
+
+class TagTree:
+    """Tag tree as used by packet headers (T.800 B.10.2)"""
+
+    parents: list[int]
+    values: list[int]
+    lows: list[int]
+
+    def __init__(self, w: int, h: int):
+        self.parents = []
+        level_sizes = [(w, h)]
+
+        while w * h > 1:
+            w, h = ceildiv(w, 2), ceildiv(h, 2)
+            level_sizes.append((w, h))
+
+        offset = 0
+        for i, (lw, lh) in enumerate(level_sizes):
+            next_offset = offset + lw * lh
+
+            for y in range(lh):
+                for x in range(lw):
+                    if i + 1 < len(level_sizes):
+                        pw = level_sizes[i + 1][0]
+                        self.parents.append(next_offset + (y // 2) * pw + x // 2)
+                    else:
+                        self.parents.append(-1)
+
+            offset = next_offset
+
+        self.values = [1 << 30] * len(self.parents)
+        self.lows = [0] * len(self.parents)
+
+    def decode(self, bio: "BitReader", leaf: int, threshold: int) -> bool:
+        stack = []
+        node = leaf
+
+        while self.parents[node] != -1:
+            stack.append(node)
+            node = self.parents[node]
+
+        low = 0
+
+        while True:
+            if low > self.lows[node]:
+                self.lows[node] = low
+            else:
+                low = self.lows[node]
+
+            while low < threshold and low < self.values[node]:
+                if bio.read(1):
+                    self.values[node] = low
+                else:
+                    low += 1
+
+            self.lows[node] = low
+
+            if not stack:
+                break
+
+            node = stack.pop()
+
+        return self.values[node] < threshold
+
+
+class BitReader:
+    """Packet header bit reader, with the bit stuffing after 0xff bytes"""
+
+    data: bytes
+    pos: int
+    buf: int
+    ct: int
+
+    def __init__(self, data: bytes, pos: int):
+        self.data = data
+        self.pos = pos
+        self.buf = 0
+        self.ct = 0
+
+    def bytein(self) -> None:
+        if self.pos >= len(self.data):
+            raise Truncated
+
+        self.buf = (self.buf << 8) & 0xFFFF
+        self.ct = 7 if self.buf == 0xFF00 else 8
+        self.buf |= self.data[self.pos]
+        self.pos += 1
+
+    def read(self, n: int) -> int:
+        v = 0
+
+        for _ in range(n):
+            if self.ct == 0:
+                self.bytein()
+
+            self.ct -= 1
+            v = (v << 1) | ((self.buf >> self.ct) & 1)
+
+        return v
+
+    def align(self) -> None:
+        if (self.buf & 0xFF) == 0xFF:
+            self.bytein()
+
+        self.ct = 0
+
+
+class CodeBlock:
+    included: bool
+    numlenbits: int
+    segments: list[list[int]]
+    """[maxpasses, numpasses] of each codeword segment"""
+
+    def __init__(self) -> None:
+        self.included = False
+        self.numlenbits = 3
+        self.segments = []
+
+
+class Precinct:
+    bands: list[tuple[int, int, TagTree, TagTree, list[CodeBlock]]]
+    """(cw, ch, inclusion tree, zero bit-plane tree, code-blocks) of each band"""
+
+    def __init__(self) -> None:
+        self.bands = []
+
+
+class Resolution:
+    x0: int
+    y0: int
+    x1: int
+    y1: int
+    pdx: int
+    pdy: int
+    pw: int
+    ph: int
+    precincts: list[Precinct]
+
+
+class Component:
+    dx: int
+    dy: int
+    style: CodingStyle
+    resolutions: list[Resolution]
+
+
+def build_component(tile: tuple[int, int, int, int], dx: int, dy: int, style: CodingStyle) -> Component:
+    comp = Component()
+    comp.dx, comp.dy, comp.style = dx, dy, style
+    comp.resolutions = []
+
+    tcx0, tcy0 = ceildiv(tile[0], dx), ceildiv(tile[1], dy)
+    tcx1, tcy1 = ceildiv(tile[2], dx), ceildiv(tile[3], dy)
+    numres = style.levels + 1
+
+    for resno in range(numres):
+        levelno = numres - 1 - resno
+        res = Resolution()
+        res.x0, res.y0 = ceildivpow2(tcx0, levelno), ceildivpow2(tcy0, levelno)
+        res.x1, res.y1 = ceildivpow2(tcx1, levelno), ceildivpow2(tcy1, levelno)
+        res.pdx, res.pdy = style.precincts[resno]
+
+        tlprcx = (res.x0 >> res.pdx) << res.pdx
+        tlprcy = (res.y0 >> res.pdy) << res.pdy
+        brprcx = ceildivpow2(res.x1, res.pdx) << res.pdx
+        brprcy = ceildivpow2(res.y1, res.pdy) << res.pdy
+        res.pw = 0 if res.x0 == res.x1 else (brprcx - tlprcx) >> res.pdx
+        res.ph = 0 if res.y0 == res.y1 else (brprcy - tlprcy) >> res.pdy
+
+        if resno == 0:
+            tlcbgx, tlcbgy = tlprcx, tlprcy
+            cbgw, cbgh = res.pdx, res.pdy
+            bands = [(0, 0, levelno)]
+        else:
+            tlcbgx, tlcbgy = ceildivpow2(tlprcx, 1), ceildivpow2(tlprcy, 1)
+            cbgw, cbgh = res.pdx - 1, res.pdy - 1
+            bands = [(1, 0, levelno + 1), (0, 1, levelno + 1), (1, 1, levelno + 1)]
+
+        cblkw = min(style.cblkw, cbgw)
+        cblkh = min(style.cblkh, cbgh)
+
+        res.precincts = [Precinct() for _ in range(res.pw * res.ph)]
+
+        for x0b, y0b, bandlevel in bands:
+            # high-pass bands are offset by half a sample at their level
+            xoff, yoff = (x0b << bandlevel) >> 1, (y0b << bandlevel) >> 1
+            bx0, by0 = ceildivpow2(tcx0 - xoff, bandlevel), ceildivpow2(tcy0 - yoff, bandlevel)
+            bx1, by1 = ceildivpow2(tcx1 - xoff, bandlevel), ceildivpow2(tcy1 - yoff, bandlevel)
+
+            for precno, prc in enumerate(res.precincts):
+                cbgx = tlcbgx + (precno % res.pw) * (1 << cbgw)
+                cbgy = tlcbgy + (precno // res.pw) * (1 << cbgh)
+                px0, py0 = max(cbgx, bx0), max(cbgy, by0)
+                px1, py1 = min(cbgx + (1 << cbgw), bx1), min(cbgy + (1 << cbgh), by1)
+
+                if px0 >= px1 or py0 >= py1:
+                    cw = ch = 0
+                else:
+                    cw = (ceildivpow2(px1, cblkw) - (px0 >> cblkw))
+                    ch = (ceildivpow2(py1, cblkh) - (py0 >> cblkh))
+
+                prc.bands.append((
+                    cw,
+                    ch,
+                    TagTree(cw, ch),
+                    TagTree(cw, ch),
+                    [CodeBlock() for _ in range(cw * ch)],
+                ))
+
+        comp.resolutions.append(res)
+
+    return comp
+
+
+def iter_packets(
+    tile: tuple[int, int, int, int], comps: list[Component], style: CodingStyle
+) -> Iterator[tuple[int, int, int, int]]:
+    """Yield (layer, component, resolution, precinct) for every packet, in codestream order"""
+
+    tx0, ty0, tx1, ty1 = tile
+    maxres = max(len(comp.resolutions) for comp in comps)
+    layers = range(style.layers)
+
+    def precinct_at(x: int, y: int, comp: Component, resno: int) -> int:
+        res = comp.resolutions[resno]
+        levelno = len(comp.resolutions) - 1 - resno
+        trx0, try0 = ceildiv(tx0, comp.dx << levelno), ceildiv(ty0, comp.dy << levelno)
+        trx1, try1 = ceildiv(tx1, comp.dx << levelno), ceildiv(ty1, comp.dy << levelno)
+        rpx, rpy = res.pdx + levelno, res.pdy + levelno
+
+        # -1 when no precinct of this resolution starts at (x, y)
+        if not (y % (comp.dy << rpy) == 0 or (y == ty0 and (try0 << levelno) % (1 << rpy))):
+            return -1
+        if not (x % (comp.dx << rpx) == 0 or (x == tx0 and (trx0 << levelno) % (1 << rpx))):
+            return -1
+        if res.pw == 0 or res.ph == 0 or trx0 == trx1 or try0 == try1:
+            return -1
+
+        prci = (ceildiv(x, comp.dx << levelno) >> res.pdx) - (trx0 >> res.pdx)
+        prcj = (ceildiv(y, comp.dy << levelno) >> res.pdy) - (try0 >> res.pdy)
+
+        return prci + prcj * res.pw
+
+    def steps(selected: list[Component]) -> tuple[int, int]:
+        dx = min(
+            comp.dx << (res.pdx + len(comp.resolutions) - 1 - resno)
+            for comp in selected
+            for resno, res in enumerate(comp.resolutions)
+        )
+        dy = min(
+            comp.dy << (res.pdy + len(comp.resolutions) - 1 - resno)
+            for comp in selected
+            for resno, res in enumerate(comp.resolutions)
+        )
+        return dx, dy
+
+    def positions(dx: int, dy: int) -> Iterator[tuple[int, int]]:
+        y = ty0
+        while y < ty1:
+            x = tx0
+            while x < tx1:
+                yield x, y
+                x += dx - (x % dx)
+            y += dy - (y % dy)
+
+    if style.progression == LRCP:
+        for layno in layers:
+            for resno in range(maxres):
+                for compno, comp in enumerate(comps):
+                    if resno < len(comp.resolutions):
+                        res = comp.resolutions[resno]
+                        for precno in range(res.pw * res.ph):
+                            yield layno, compno, resno, precno
+    elif style.progression == RLCP:
+        for resno in range(maxres):
+            for layno in layers:
+                for compno, comp in enumerate(comps):
+                    if resno < len(comp.resolutions):
+                        res = comp.resolutions[resno]
+                        for precno in range(res.pw * res.ph):
+                            yield layno, compno, resno, precno
+    elif style.progression == RPCL:
+        dx, dy = steps(comps)
+        for resno in range(maxres):
+            for x, y in positions(dx, dy):
+                for compno, comp in enumerate(comps):
+                    if resno < len(comp.resolutions):
+                        precno = precinct_at(x, y, comp, resno)
+                        if precno != -1:
+                            for layno in layers:
+                                yield layno, compno, resno, precno
+    elif style.progression == PCRL:
+        dx, dy = steps(comps)
+        for x, y in positions(dx, dy):
+            for compno, comp in enumerate(comps):
+                for resno in range(len(comp.resolutions)):
+                    precno = precinct_at(x, y, comp, resno)
+                    if precno != -1:
+                        for layno in layers:
+                            yield layno, compno, resno, precno
+    elif style.progression == CPRL:
+        for compno, comp in enumerate(comps):
+            dx, dy = steps([comp])
+            for x, y in positions(dx, dy):
+                for resno in range(len(comp.resolutions)):
+                    precno = precinct_at(x, y, comp, resno)
+                    if precno != -1:
+                        for layno in layers:
+                            yield layno, compno, resno, precno
+    else:
+        raise UnsupportedCodestream(f"unknown progression order {style.progression}")
+
+
+def read_packet(data: bytes, pos: int, prc: Precinct, layno: int, style: CodingStyle) -> int:
+    """Parse one packet header starting at pos and return the offset the packet ends at"""
+
+    # optional start of packet marker
+    if style.use_sop and data[pos:pos + 2] == b"\xff\x91":
+        pos += 6
+
+    bio = BitReader(data, pos)
+    body_length = 0
+    new_passes: list[tuple[CodeBlock, list[int]]] = []
+
+    if bio.read(1):
+        for cw, ch, incltree, imsbtree, cblks in prc.bands:
+            for cblkno, cblk in enumerate(cblks):
+                if not cblk.included:
+                    included = incltree.decode(bio, cblkno, layno + 1)
+                else:
+                    included = bool(bio.read(1))
+
+                if not included:
+                    continue
+
+                if not cblk.included:
+                    i = 0
+                    while not imsbtree.decode(bio, cblkno, i):
+                        i += 1
+                        if i > 64:
+                            raise UnsupportedCodestream("corrupt zero bit-plane tag tree")
+
+                    cblk.segments.append([first_segment_passes(style.cblksty), 0])
+                    cblk.included = True
+                elif cblk.segments[-1][1] == cblk.segments[-1][0]:
+                    cblk.segments.append([next_segment_passes(style.cblksty, cblk.segments[-1][0]), 0])
+
+                n = read_num_passes(bio)
+
+                while bio.read(1):
+                    cblk.numlenbits += 1
+
+                counts = []
+                segno = len(cblk.segments) - 1
+
+                while True:
+                    maxpasses, numpasses = cblk.segments[segno]
+                    newpasses = min(maxpasses - numpasses, n)
+                    body_length += bio.read(cblk.numlenbits + newpasses.bit_length() - 1)
+                    counts.append(newpasses)
+                    n -= newpasses
+
+                    if n <= 0:
+                        break
+
+                    cblk.segments.append([next_segment_passes(style.cblksty, maxpasses), 0])
+                    segno += 1
+
+                new_passes.append((cblk, counts))
+
+    bio.align()
+    pos = bio.pos
+
+    # optional end of packet header marker
+    if style.use_eph and data[pos:pos + 2] == b"\xff\x92":
+        pos += 2
+
+    end = pos + body_length
+
+    if end > len(data):
+        raise Truncated
+
+    # only commit pass counts once the whole packet is known to be present
+    for cblk, counts in new_passes:
+        first = len(cblk.segments) - len(counts)
+        for segment, count in zip(cblk.segments[first:], counts):
+            segment[1] += count
+
+    return end
+
+
+def first_segment_passes(cblksty: int) -> int:
+    if cblksty & CBLKSTY_TERMALL:
+        return 1
+    if cblksty & CBLKSTY_LAZY:
+        return 10
+    return 109
+
+
+def next_segment_passes(cblksty: int, previous: int) -> int:
+    if cblksty & CBLKSTY_TERMALL:
+        return 1
+    if cblksty & CBLKSTY_LAZY:
+        return 2 if previous in (1, 10) else 1
+    return 109
+
+
+def read_num_passes(bio: BitReader) -> int:
+    if not bio.read(1):
+        return 1
+    if not bio.read(1):
+        return 2
+
+    n = bio.read(2)
+    if n != 3:
+        return 3 + n
+
+    n = bio.read(5)
+    if n != 31:
+        return 6 + n
+
+    return 37 + bio.read(7)
+
+
+def read_marker(data: bytes, pos: int) -> tuple[int, bytes, int]:
+    """Read a marker segment at pos, returning (marker, parameters, next position)"""
+
+    if pos + 4 > len(data):
+        raise Truncated
+
+    marker, length = struct.unpack_from(">HH", data, pos)
+
+    if pos + 2 + length > len(data):
+        raise Truncated
+
+    return marker, data[pos + 4:pos + 2 + length], pos + 2 + length
+
+
+def read_header(data: bytes, pos: int, until: int) -> tuple[list[tuple[int, bytes]], int]:
+    """Read marker segments up to (not including) the `until` marker"""
+
+    markers: list[tuple[int, bytes]] = []
+
+    while True:
+        if pos + 2 > len(data):
+            raise Truncated
+
+        (marker,) = struct.unpack_from(">H", data, pos)
+
+        if marker == until:
+            return markers, pos
+
+        marker, params, pos = read_marker(data, pos)
+        markers.append((marker, params))
+
+
+def apply_coding_style(
+    markers: list[tuple[int, bytes]],
+    style: CodingStyle | None,
+    comp_styles: dict[int, CodingStyle],
+    csiz: int,
+) -> CodingStyle | None:
+    """Apply the COD and then COC markers of one header, returning the coding style"""
+
+    for marker, params in markers:
+        if marker in (POC, PPM, PPT):
+            raise UnsupportedCodestream(f"unsupported marker {marker:#06x}")
+
+        if marker == COD:
+            scod, progression, layers = struct.unpack_from(">BBH", params)
+            style = CodingStyle(scod, progression, layers, params[5:])
+            # a COD in a tile header overrides COC markers from the main header
+            comp_styles.clear()
+
+    for marker, params in markers:
+        if marker == COC:
+            if style is None:
+                raise UnsupportedCodestream("COC marker without COD")
+
+            if csiz < 257:
+                compno, scoc = params[0], params[1]
+                spcoc = params[2:]
+            else:
+                compno, scoc = struct.unpack_from(">HB", params)
+                spcoc = params[3:]
+
+            comp_style = style.copy()
+            comp_style.set_component_style(scoc, spcoc)
+            comp_styles[compno] = comp_style
+
+    return style
+
+
+def salvage_codestream(data: bytes) -> Salvaged | None:
+    """
+    Cut a truncated JPEG 2000 codestream down to its complete packets.
+
+    also works out how many resolution levels and quality layers are fully
+    present, which map to pillow's `reduce` and `layers` decoding options.
+    returns None if not even one layer of the lowest resolution level is
+    complete, or if the codestream uses features this parser doesn't handle.
+    """
+
+    try:
+        return _salvage_codestream(data)
+    except (Truncated, UnsupportedCodestream, struct.error, IndexError, ValueError, ZeroDivisionError):
+        return None
+
+
+def _salvage_codestream(data: bytes) -> Salvaged | None:
+    if data[:2] != b"\xff\x4f":
+        raise UnsupportedCodestream("not a JPEG 2000 codestream")
+
+    markers, pos = read_header(data, 2, SOT)
+    siz_params = next((params for marker, params in markers if marker == SIZ), None)
+
+    if siz_params is None:
+        raise UnsupportedCodestream("missing SIZ marker")
+
+    siz = struct.unpack_from(">HIIIIIIIIH", siz_params)
+    subsampling = [(siz_params[36 + 3 * i + 1], siz_params[36 + 3 * i + 2]) for i in range(siz[9])]
+    comp_styles: dict[int, CodingStyle] = {}
+    style = apply_coding_style(markers, None, comp_styles, siz[9])
+
+    if style is None:
+        raise UnsupportedCodestream("missing COD marker")
+
+    _, xsiz, ysiz, xosiz, yosiz, xtsiz, ytsiz, xtosiz, ytosiz, csiz = siz
+
+    if ceildiv(xsiz - xtosiz, xtsiz) != 1 or ceildiv(ysiz - ytosiz, ytsiz) != 1:
+        raise UnsupportedCodestream("multiple tiles")
+
+    main_header_end = pos
+    tile = (max(xtosiz, xosiz), max(ytosiz, yosiz), min(xtosiz + xtsiz, xsiz), min(ytosiz + ytsiz, ysiz))
+
+    # tile-parts: (header start, header end, body end)
+    tile_parts: list[tuple[int, int, int]] = []
+    stream = bytearray()
+
+    while pos + 2 <= len(data):
+        (marker,) = struct.unpack_from(">H", data, pos)
+
+        if marker != SOT:
+            break
+
+        sot_start = pos
+        marker, params, pos = read_marker(data, pos)
+        isot, psot = struct.unpack_from(">HI", params)
+
+        if isot != 0:
+            raise UnsupportedCodestream("multiple tiles")
+
+        markers, pos = read_header(data, pos, SOD)
+        pos += 2
+        style = apply_coding_style(markers, style, comp_styles, csiz) or style
+
+        body_end = min(sot_start + psot if psot else len(data), len(data))
+
+        if psot == 0 and data[-2:] == b"\xff\xd9":
+            body_end -= 2
+
+        tile_parts.append((sot_start, pos, body_end))
+        stream += data[pos:body_end]
+        pos = body_end
+
+    if not tile_parts:
+        return None
+
+    comps = [
+        build_component(tile, dx, dy, comp_styles.get(compno, style))
+        for compno, (dx, dy) in enumerate(subsampling)
+    ]
+
+    # walk packets until one runs past the end of the data
+    stream_bytes = bytes(stream)
+    stream_pos = 0
+    completed: list[int] = []
+    order = list(iter_packets(tile, comps, style))
+
+    for layno, compno, resno, precno in order:
+        try:
+            stream_pos = read_packet(
+                stream_bytes,
+                stream_pos,
+                comps[compno].resolutions[resno].precincts[precno],
+                layno,
+                comps[compno].style,
+            )
+        except Truncated:
+            break
+
+        completed.append(stream_pos)
+
+    if not completed:
+        return None
+
+    # find the least number of resolution levels to discard, then the most
+    # quality layers to keep, so that every packet still needed is complete
+    max_reduce = min(len(comp.resolutions) for comp in comps) - 1
+    missing = order[len(completed):]
+    reduce = layers = 0
+
+    for reduce in range(max_reduce + 1):
+        layers = min(
+            (
+                layno
+                for layno, compno, resno, _ in missing
+                if resno < len(comps[compno].resolutions) - reduce
+            ),
+            default=style.layers,
+        )
+
+        if layers > 0:
+            break
+    else:
+        return None
+
+    # rebuild the codestream from complete packets only, fixing up tile-part lengths
+    cut = completed[-1]
+    out = bytearray(data[:main_header_end])
+    consumed = 0
+
+    for header_start, header_end, body_end in tile_parts:
+        if consumed >= cut:
+            break
+
+        body = data[header_end:body_end][:cut - consumed]
+        consumed += len(body)
+
+        header = bytearray(data[header_start:header_end])
+        struct.pack_into(">I", header, 6, len(header) + len(body))
+        # number of tile-parts is no longer known
+        header[11] = 0
+
+        out += header + body
+
+    out += b"\xff\xd9"
+
+    return Salvaged(codestream=bytes(out), reduce=reduce, layers=layers, max_reduce=max_reduce)
@@ -0,0 +1,114 @@
+import os
+from pathlib import Path
+import threading
+from typing import Iterable
+
+REFRESH_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+EXPORT_LATENCY_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, 86400)
+
+METRICS_INTERVAL = 1
+"""Seconds between textfile writes while a batch of textures is handled"""
+
+OUTCOMES = ("written", "partial", "existing", "incomplete", "failed", "empty")
+
+
+class Histogram:
+    buckets: tuple[float, ...]
+    counts: list[int]
+    sum: float
+    count: int
+
+    def __init__(self, buckets: Iterable[float]):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str) -> list[str]:
+        lines = [
+            f'{name}_bucket{{le="{bound:g}"}} {count}'
+            for bound, count in zip(self.buckets, self.counts)
+        ]
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum:g}")
+        lines.append(f"{name}_count {self.count}")
+
+        return lines
+
+
+class WatchMetrics:
+    """
+    Counters for a long running watch session, rendered in the prometheus text
+    exposition format. intended for the node_exporter textfile collector.
+    """
+
+    outcomes: dict[str, int]
+    refresh_duration: Histogram
+    export_latency: Histogram
+    queue_depth: int
+    bytes_written: int
+    lock: threading.Lock
+
+    def __init__(self) -> None:
+        self.outcomes = {outcome: 0 for outcome in OUTCOMES}
+        self.refresh_duration = Histogram(REFRESH_DURATION_BUCKETS)
+        self.export_latency = Histogram(EXPORT_LATENCY_BUCKETS)
+        self.queue_depth = 0
+        self.bytes_written = 0
+        self.lock = threading.Lock()
+
+    def count(self, outcome: str) -> None:
+        with self.lock:
+            self.outcomes[outcome] += 1
+
+    def observe_refresh(self, seconds: float) -> None:
+        with self.lock:
+            self.refresh_duration.observe(seconds)
+
+    def observe_export(self, *, latency: float, size: int) -> None:
+        with self.lock:
+            self.export_latency.observe(max(latency, 0))
+            self.bytes_written += size
+
+    def set_queue_depth(self, depth: int) -> None:
+        with self.lock:
+            self.queue_depth = depth
+
+    def render(self) -> str:
+        with self.lock:
+            lines = [
+                "# HELP texture_courier_textures_total Textures handled, by outcome.",
+                "# TYPE texture_courier_textures_total counter",
+                *(
+                    f'texture_courier_textures_total{{outcome="{outcome}"}} {n}'
+                    for outcome, n in self.outcomes.items()
+                ),
+                "# HELP texture_courier_refresh_duration_seconds Time spent re-reading the cache.",
+                "# TYPE texture_courier_refresh_duration_seconds histogram",
+                *self.refresh_duration.render("texture_courier_refresh_duration_seconds"),
+                "# HELP texture_courier_export_latency_seconds Time from cache entry timestamp to export.",
+                "# TYPE texture_courier_export_latency_seconds histogram",
+                *self.export_latency.render("texture_courier_export_latency_seconds"),
+                "# HELP texture_courier_handler_queue_depth Changed textures waiting to be handled.",
+                "# TYPE texture_courier_handler_queue_depth gauge",
+                f"texture_courier_handler_queue_depth {self.queue_depth}",
+                "# HELP texture_courier_written_bytes_total Bytes written to the output directory.",
+                "# TYPE texture_courier_written_bytes_total counter",
+                f"texture_courier_written_bytes_total {self.bytes_written}",
+            ]
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: Path) -> None:
+        # the textfile collector may read at any time, so swap the file in whole
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(self.render())
+        os.replace(tmp_path, path)
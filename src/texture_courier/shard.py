@@ -0,0 +1,130 @@
+import argparse
+import json
+import os
+from pathlib import Path
+from typing import Any, NamedTuple
+from uuid import UUID
+
+PROGRESS_INTERVAL = 5
+"""Seconds between summaries written while a shard is still running"""
+
+
+class Shard(NamedTuple):
+    """Shard k of n, where k counts from 1"""
+
+    k: int
+    n: int
+
+    def __str__(self) -> str:
+        return f"{self.k}/{self.n}"
+
+    def includes(self, uuid: str) -> bool:
+        # membership only depends on the uuid, so it is stable no matter how the
+        # entry table is ordered or how often the cache is refreshed
+        return UUID(uuid).int % self.n == self.k - 1
+
+    @classmethod
+    def parse(cls, s: str) -> "Shard":
+        try:
+            k, n = (int(part) for part in s.split("/"))
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid shard '{s}', expected K/N")
+
+        if n < 1 or not 1 <= k <= n:
+            raise argparse.ArgumentTypeError(f"invalid shard '{s}', K must be between 1 and N")
+
+        return cls(k, n)
+
+
+class ShardSummary(NamedTuple):
+    shard: Shard
+    complete: bool
+    good_writes: int
+    existing_textures: int
+    incomplete_textures: int
+    error_write_textures: int
+    empty_textures: int
+    partial_writes: int = 0
+    """Salvaged partial textures, missing from summaries of older versions"""
+
+
+def shard_summary_path(output_dir: Path, shard: Shard) -> Path:
+    return output_dir / f".texture-courier-shard-{shard.k}-of-{shard.n}.json"
+
+
+def write_shard_summary(output_dir: Path, summary: ShardSummary) -> Path:
+    path = shard_summary_path(output_dir, summary.shard)
+    data = summary._asdict() | {"shard": str(summary.shard)}
+
+    # shards may share storage, so never leave a half written summary behind
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(json.dumps(data))
+    os.replace(tmp_path, path)
+
+    return path
+
+
+def read_shard_summary(path: Path) -> ShardSummary:
+    """
+    Read one shard summary.
+
+    raises ValueError naming the file if it isn't a valid summary, or if it was
+    written by a different shard than its file name says.
+    """
+
+    try:
+        data: dict[str, Any] = json.loads(path.read_text())
+        data["shard"] = Shard.parse(str(data["shard"]))
+        summary = ShardSummary(**data)
+    except (ValueError, KeyError, TypeError, argparse.ArgumentTypeError) as e:
+        raise ValueError(f"invalid shard summary {path}: {e}") from e
+
+    if not isinstance(summary.complete, bool) or not all(
+        isinstance(n, int) and not isinstance(n, bool) and n >= 0 for n in summary[2:]
+    ):
+        raise ValueError(f"invalid shard summary {path}: counts must be non-negative integers")
+
+    if path.name != shard_summary_path(path.parent, summary.shard).name:
+        raise ValueError(f"invalid shard summary {path}: written by shard {summary.shard}")
+
+    return summary
+
+
+def read_shard_summaries(output_dir: Path) -> list[ShardSummary]:
+    return [
+        read_shard_summary(path)
+        for path in sorted(output_dir.glob(".texture-courier-shard-*-of-*.json"))
+    ]
+
+
+def merge_shard_summaries(summaries: list[ShardSummary]) -> ShardSummary:
+    """
+    Combine the summaries of every shard of one extraction into one.
+
+    raises ValueError if the summaries don't cover exactly one set of N shards.
+    """
+
+    if not summaries:
+        raise ValueError("no shard summaries found")
+
+    n = summaries[0].shard.n
+
+    if any(summary.shard.n != n for summary in summaries):
+        raise ValueError("shard summaries come from extractions with different shard counts")
+
+    found = {summary.shard.k for summary in summaries}
+    missing = sorted(set(range(1, n + 1)) - found)
+
+    if missing:
+        raise ValueError(f"missing summaries for shards {', '.join(f'{k}/{n}' for k in missing)}")
+
+    return ShardSummary(
+        shard=Shard(1, 1),
+        complete=all(summary.complete for summary in summaries),
+        good_writes=sum(summary.good_writes for summary in summaries),
+        existing_textures=sum(summary.existing_textures for summary in summaries),
+        incomplete_textures=sum(summary.incomplete_textures for summary in summaries),
+        error_write_textures=sum(summary.error_write_textures for summary in summaries),
+        empty_textures=sum(summary.empty_textures for summary in summaries),
+        partial_writes=sum(summary.partial_writes for summary in summaries),
+    )
@@ -0,0 +1,82 @@
+from datetime import datetime
+import hashlib
+from io import BytesIO
+import json
+import os
+from pathlib import Path
+from typing import Any, NamedTuple
+
+from .core import Header, Entry
+
+SNAPSHOT_VERSION = 1
+
+
+class EntriesKey(NamedTuple):
+    """Identifies one exact revision of a texture.entries file"""
+
+    size: int
+    mtime_ns: int
+    digest: str
+
+    @classmethod
+    def from_stat(cls, stat: os.stat_result, texture_entries: BytesIO) -> "EntriesKey":
+        return cls(
+            size=stat.st_size,
+            mtime_ns=stat.st_mtime_ns,
+            digest=hashlib.blake2b(texture_entries.getbuffer(), digest_size=16).hexdigest(),
+        )
+
+
+class Snapshot(NamedTuple):
+    key: EntriesKey
+    header: Header
+    entries: list[Entry]
+
+
+def read_snapshot(path: Path, cache_dir: Path) -> Snapshot | None:
+    """
+    Load a previously written snapshot of the decoded entry table.
+
+    returns None if the snapshot is missing, unreadable, from another version,
+    or belongs to a different cache directory.
+    """
+
+    try:
+        data: dict[str, Any] = json.loads(path.read_bytes())
+
+        if data["version"] != SNAPSHOT_VERSION or data["cache_dir"] != str(cache_dir.resolve()):
+            return None
+
+        return Snapshot(
+            key=EntriesKey(*data["key"]),
+            header=Header(**data["header"]),
+            entries=[
+                Entry(
+                    uuid=uuid,
+                    image_size=image_size,
+                    body_size=body_size,
+                    time=datetime.fromtimestamp(timestamp),
+                )
+                for uuid, image_size, body_size, timestamp in data["entries"]
+            ],
+        )
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def write_snapshot(path: Path, cache_dir: Path, snapshot: Snapshot) -> None:
+    data = {
+        "version": SNAPSHOT_VERSION,
+        "cache_dir": str(cache_dir.resolve()),
+        "key": list(snapshot.key),
+        "header": dict(snapshot.header),
+        "entries": [
+            [entry.uuid, entry.image_size, entry.body_size, int(entry.time.timestamp())]
+            for entry in snapshot.entries
+        ],
+    }
+
+    # write to a temporary file first so a crash never leaves a torn snapshot
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(json.dumps(data, separators=(",", ":")))
+    os.replace(tmp_path, path)